@@ -1,77 +1,131 @@
 
 # backup_restore.py
-import os, json, base64
+import os, json, hashlib, threading
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from mutagen import File
 from mutagen.id3 import ID3, ID3NoHeaderError, TXXX, APIC, Frames
 from mutagen.flac import Picture
 from mutagen.mp4 import MP4, MP4Cover
 
-def backup_tags(audio, path: str, rel: str, backup_dir: str):
+from utils_mb import load_id3
+
+BACKUP_FORMAT_VERSION = 2
+
+
+# Les images sont stockées à part (blobs/<sha1>.bin) : une seule copie par pochette d'album.
+# pic_cache (optionnel, partagé sur un run) : sha1 déjà présents sur disque, évite le stat par piste.
+def _store_blob(backup_dir: str, blob: bytes, pic_cache: set = None) -> str:
+    sha1 = hashlib.sha1(blob).hexdigest()
+    if pic_cache is not None and sha1 in pic_cache:
+        return sha1
+    bpath = os.path.join(backup_dir, 'blobs', sha1+'.bin')
+    if not os.path.exists(bpath):
+        os.makedirs(os.path.dirname(bpath), exist_ok=True)
+        tmp = f'{bpath}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp,'wb') as f: f.write(blob)
+        os.replace(tmp, bpath)
+    if pic_cache is not None: pic_cache.add(sha1)
+    return sha1
+
+
+def _load_blob(backup_dir: str, entry: dict) -> bytes:
+    if 'data_ref' in entry:
+        with open(os.path.join(backup_dir, 'blobs', entry['data_ref']+'.bin'),'rb') as f: return f.read()
+    return _b64.b64decode(entry['data'], validate=False)  # backup format_version 1
+
+
+def _dump_json(data: dict, out: str):
+    # default=str : les frames ID3 peuvent contenir des ID3TimeStamp (TDRC…)
+    if orjson is not None:
+        with open(out,'wb') as f: f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2, default=str))
+    else:
+        with open(out,'w',encoding='utf-8') as f: json.dump(data,f,indent=2,default=str)
+
+
+def _load_json(in_path: str) -> dict:
+    if orjson is not None:
+        with open(in_path,'rb') as f: return orjson.loads(f.read())
+    with open(in_path,'r',encoding='utf-8') as f: return json.load(f)
+
+
+def backup_tags(audio, path: str, rel: str, backup_dir: str, ext: str = None, pic_cache: set = None):
     os.makedirs(backup_dir, exist_ok=True)
     out = os.path.join(backup_dir, rel.replace(os.sep,'__')+'.json')
-    ext = os.path.splitext(path)[1].lower()
-    data = {"path": rel, "format": None, "tags": {}}
+    if ext is None: ext = os.path.splitext(path)[1].lower()
+    tags = {}
+    data = {"format_version": BACKUP_FORMAT_VERSION, "path": rel, "format": None, "tags": tags}
     if ext=='.mp3':
         data['format']='MP3'
-        try: id3=ID3(path)
+        try: id3=load_id3(audio, path)
         except ID3NoHeaderError: id3=None
         if id3:
             for f in id3.values():
                 fid=f.FrameID
                 if fid=='APIC':
-                    data['tags']['APIC']={"mime":f.mime,"desc":f.desc,"type":f.type,"data":base64.b64encode(f.data).decode('ascii')}
+                    tags['APIC']={"mime":f.mime,"desc":f.desc,"type":f.type,"data_ref":_store_blob(backup_dir, f.data, pic_cache)}
                 elif fid=='TXXX':
-                    data['tags'][f'TXXX:{f.desc}']=f.text
+                    tags[f'TXXX:{f.desc}']=f.text
                 else:
-                    try: data['tags'][fid]=f.text
-                    except: data['tags'][fid]=str(f)
+                    try: tags[fid]=f.text
+                    except: tags[fid]=str(f)
     elif isinstance(audio, MP4):
         data['format']='MP4'
         for k,v in (audio.tags or {}).items():
             if k=='covr':
                 covers=[]
                 for c in v:
-                    covers.append({"data":base64.b64encode(bytes(c)).decode('ascii'),"type":c.imageformat})
-                data['tags']['covr']=covers
+                    covers.append({"data_ref":_store_blob(backup_dir, bytes(c), pic_cache),"type":c.imageformat})
+                tags['covr']=covers
             else:
-                try: data['tags'][k]=[vv.decode('utf-8','ignore') if isinstance(vv,bytes) else str(vv) for vv in v]
-                except: data['tags'][k]=str(v)
+                try: tags[k]=[vv.decode('utf-8','ignore') if isinstance(vv,bytes) else str(vv) for vv in v]
+                except: tags[k]=str(v)
     else:
         data['format']='VORBIS'
         if audio.tags:
-            for k,v in audio.tags.items(): data['tags'][k]=v
+            for k,v in audio.tags.items(): tags[k]=v
         if hasattr(audio,'pictures'):
             pics=[]
             for p in audio.pictures:
-                pics.append({"mime":p.mime,"type":p.type,"desc":p.desc,"data":base64.b64encode(p.data).decode('ascii')})
-            data['tags']['__PICTURES__']=pics
-    with open(out,'w',encoding='utf-8') as f: json.dump(data,f,indent=2)
+                pics.append({"mime":p.mime,"type":p.type,"desc":p.desc,"data_ref":_store_blob(backup_dir, p.data, pic_cache)})
+            tags['__PICTURES__']=pics
+    _dump_json(data, out)
     return out
 
 
-def restore_tags(path: str, rel: str, backup_dir: str):
+def restore_tags(path: str, rel: str, backup_dir: str, audio=None):
+    """Restaure les tags depuis le backup. `audio` (déjà ouvert) est modifié en place."""
     in_path = os.path.join(backup_dir, rel.replace(os.sep,'__')+'.json')
     if not os.path.exists(in_path):
         return False, 'Backup manquant'
-    with open(in_path,'r',encoding='utf-8') as f: data=json.load(f)
-    audio = File(path, easy=False)
+    data=_load_json(in_path)
+    if audio is None: audio = File(path, easy=False)
     fmt=data.get('format'); tags=data.get('tags',{})
     if fmt=='MP3':
-        try: id3=ID3(path)
-        except ID3NoHeaderError: id3=ID3()
-        id3.delete()
+        # Frames construites d'abord ; tags vidés en mémoire puis une seule écriture du fichier
+        frames=[]; _fget=Frames.get
         for k,v in tags.items():
             if k=='APIC':
-                blob=base64.b64decode(v['data'])
-                id3.add(APIC(mime=v.get('mime'), desc=v.get('desc'), type=v.get('type',3), data=blob))
+                blob=_load_blob(backup_dir, v)
+                frames.append(APIC(mime=v.get('mime'), desc=v.get('desc'), type=v.get('type',3), data=blob))
             elif k.startswith('TXXX:'):
-                desc=k.split(':',1)[1]; id3.add(TXXX(encoding=3, desc=desc, text=v))
+                desc=k.split(':',1)[1]; frames.append(TXXX(encoding=3, desc=desc, text=v))
             else:
-                cls=Frames.get(k)
+                cls=_fget(k)
                 if cls:
-                    try: id3.add(cls(encoding=3, text=v))
+                    try: frames.append(cls(encoding=3, text=v))
                     except: pass
-        id3.save(v2_version=3); return True, 'Tags restaurés (MP3)'
+        try: id3=load_id3(audio, path)
+        except ID3NoHeaderError: id3=ID3()
+        id3.clear()  # en mémoire seulement ; v1=0 supprime l'ID3v1 comme le faisait delete()
+        for fr in frames: id3.add(fr)
+        id3.save(path, v1=0, v2_version=3); return True, 'Tags restaurés (MP3)'
     if fmt=='VORBIS':
         try: audio.delete()
         except: pass
@@ -81,7 +135,7 @@ def restore_tags(path: str, rel: str, backup_dir: str):
                     try: audio.clear_pictures()
                     except: pass
                 for p in v:
-                    pic=Picture(); pic.mime=p['mime']; pic.type=p['type']; pic.desc=p['desc']; pic.data=base64.b64decode(p['data'])
+                    pic=Picture(); pic.mime=p['mime']; pic.type=p['type']; pic.desc=p['desc']; pic.data=_load_blob(backup_dir, p)
                     try: audio.add_picture(pic)
                     except: pass
             else:
@@ -94,7 +148,7 @@ def restore_tags(path: str, rel: str, backup_dir: str):
         for k,v in tags.items():
             if k=='covr':
                 covs=[]
-                for c in v: covs.append(MP4Cover(base64.b64decode(c['data']), c['type']))
+                for c in v: covs.append(MP4Cover(_load_blob(backup_dir, c), c['type']))
                 audio.tags['covr']=covs
             else:
                 audio.tags[k]=v
@@ -1,33 +1,76 @@
 
 # cache.py
-import sqlite3, time
+import sqlite3, threading, time
+
+_MEM_MAX = 50000  # entrées par memo en RAM (FIFO)
 
 class MbCache:
-    def __init__(self, db_path: str, mode: str = 'rw', ttl: int = 86400):
+    def __init__(self, db_path: str, mode: str = 'rw', ttl: int = 86400, commit_every: int = 128):
         self.db_path = db_path
         self.mode = mode
         self.ttl = ttl
-        self.conn = sqlite3.connect(self.db_path)
+        # Connexion partagée entre les threads de main() : un seul écrivain à la fois (verrou + WAL)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._lock = threading.RLock()
         self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.execute('PRAGMA temp_store=MEMORY;')
+        self.conn.execute('PRAGMA mmap_size=268435456;')  # 256 Mo
+        self.conn.execute('PRAGMA cache_size=-40000;')    # 40 Mo de cache de pages
+        self._cur = self.conn.cursor()
+        self._pending = 0
+        self._commit_every = commit_every
+        # Memo du run devant SQLite : mbid -> (rating, votes, ts) / qkey -> (mbid, ts)
+        self._rating_mem = {}
+        self._qkey_mem = {}
         self._init()
 
     def _init(self):
-        c = self.conn.cursor()
-        c.execute(
+        c = self._cur
+        c.execute('''
             CREATE TABLE IF NOT EXISTS ratings (
               mbid TEXT PRIMARY KEY,
               rating REAL,
               votes INTEGER,
               fetched_at INTEGER
             )
-        )
-        c.execute(
+        ''')
+        c.execute('''
             CREATE TABLE IF NOT EXISTS search_map (
               qkey TEXT PRIMARY KEY,
               mbid TEXT,
               fetched_at INTEGER
             )
-        )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+              path TEXT PRIMARY KEY,
+              mtime_ns INTEGER,
+              size INTEGER,
+              mbid TEXT,
+              rating REAL,
+              votes INTEGER,
+              popm INTEGER,
+              artist TEXT,
+              title TEXT,
+              duration_ms INTEGER,
+              has_cover INTEGER,
+              exotic TEXT,
+              exotic_scanned INTEGER
+            )
+        ''')
+        # Bases créées avant exotic_scanned : colonne ajoutée, anciennes lignes à NULL (scan inconnu)
+        c.execute('PRAGMA table_info(files)')
+        if 'exotic_scanned' not in [r[1] for r in c.fetchall()]:
+            c.execute('ALTER TABLE files ADD COLUMN exotic_scanned INTEGER')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS http_cache (
+              key TEXT PRIMARY KEY,
+              etag TEXT,
+              body BLOB,
+              fetched_at INTEGER
+            )
+        ''')
         self.conn.commit()
 
     @staticmethod
@@ -35,44 +78,131 @@ class MbCache:
         a=(artist or '').strip().lower(); t=(title or '').strip().lower(); d=int(round((duration_ms or 0)/1000))
         return f"{a}|{t}|{d}"
 
+    def _wrote(self, n: int = 1):
+        # Commit par lots : un fsync tous les `commit_every` écritures au lieu d'un par fichier
+        self._pending += n
+        if self._pending >= self._commit_every: self.flush()
+
+    @staticmethod
+    def _remember(mem: dict, k, v):
+        mem[k] = v
+        if len(mem) > _MEM_MAX: del mem[next(iter(mem))]
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self.conn.commit(); self._pending = 0
+
     def get_rating(self, mbid: str):
         if self.mode == 'refresh': return None
-        c=self.conn.cursor(); c.execute('SELECT rating,votes,fetched_at FROM ratings WHERE mbid=?',(mbid,))
-        r=c.fetchone();
+        with self._lock:
+            r=self._rating_mem.get(mbid)
+            if r is None:
+                c=self._cur; c.execute('SELECT rating,votes,fetched_at FROM ratings WHERE mbid=?',(mbid,))
+                r=c.fetchone();
+                if r: self._remember(self._rating_mem, mbid, r)
         if not r: return None
         rating,votes,ts=r
         if self.mode!='ro' and (time.time()-ts)>self.ttl: return None
         return rating, votes
 
     def set_rating(self, mbid:str, rating, votes):
+        self.set_ratings_many([(mbid, rating, votes)])
+
+    def set_ratings_many(self, rows):
+        """rows : itérable de (mbid, rating, votes)."""
         if self.mode=='ro': return
-        c=self.conn.cursor(); c.execute(
-            INSERT INTO ratings(mbid,rating,votes,fetched_at)
-            VALUES(?,?,?,?)
-            ON CONFLICT(mbid) DO UPDATE SET rating=excluded.rating, votes=excluded.votes, fetched_at=excluded.fetched_at
-        ,(mbid,rating,votes,int(time.time())))
-        self.conn.commit()
+        now=int(time.time()); rows=[(m,r,v,now) for (m,r,v) in rows]
+        if not rows: return
+        with self._lock:
+            self._cur.executemany('INSERT OR REPLACE INTO ratings(mbid,rating,votes,fetched_at) VALUES(?,?,?,?)', rows)
+            for (m,r,v,ts) in rows: self._remember(self._rating_mem, m, (r,v,ts))
+            self._wrote(len(rows))
 
     def get_search_mbid(self, artist, title, duration_ms):
+        return self.get_search_mbid_by_key(self.key(artist,title,duration_ms))
+
+    def get_search_mbid_by_key(self, q: str):
         if self.mode == 'refresh': return None
-        q=self.key(artist,title,duration_ms)
-        c=self.conn.cursor(); c.execute('SELECT mbid,fetched_at FROM search_map WHERE qkey=?',(q,))
-        r=c.fetchone();
+        with self._lock:
+            r=self._qkey_mem.get(q)
+            if r is None:
+                c=self._cur; c.execute('SELECT mbid,fetched_at FROM search_map WHERE qkey=?',(q,))
+                r=c.fetchone();
+                if r: self._remember(self._qkey_mem, q, r)
         if not r: return None
         mbid,ts=r
         if self.mode!='ro' and (time.time()-ts)>self.ttl: return None
         return mbid
 
     def set_search_mbid(self, artist,title,duration_ms,mbid:str):
+        self.set_search_mbid_by_key(self.key(artist,title,duration_ms), mbid)
+
+    def set_search_mbid_by_key(self, q: str, mbid: str):
+        self._write_search([(q, mbid)])
+
+    def set_search_mbids_many(self, rows):
+        """rows : itérable de (artist, title, duration_ms, mbid)."""
+        self._write_search([(self.key(a,t,d),m) for (a,t,d,m) in rows])
+
+    def _write_search(self, rows):
+        if self.mode=='ro' or not rows: return
+        now=int(time.time()); rows=[(q,m,now) for (q,m) in rows]
+        with self._lock:
+            self._cur.executemany('INSERT OR REPLACE INTO search_map(qkey,mbid,fetched_at) VALUES(?,?,?)', rows)
+            for (q,m,ts) in rows: self._remember(self._qkey_mem, q, (m,ts))
+            self._wrote(len(rows))
+
+    # Fichiers déjà notés : (path, mtime, taille) -> ce qui a été écrit au dernier run
+    _FILE_COLS = ('mbid','rating','votes','popm','artist','title','duration_ms','has_cover','exotic','exotic_scanned')
+
+    def get_file(self, path: str, mtime_ns: int, size: int):
+        if self.mode == 'refresh': return None
+        with self._lock:
+            c=self._cur; c.execute('SELECT '+','.join(self._FILE_COLS)+' FROM files WHERE path=? AND mtime_ns=? AND size=?',(path,mtime_ns,size))
+            r=c.fetchone();
+        if not r: return None
+        entry=dict(zip(self._FILE_COLS, r))
+        entry['popm']=bool(entry['popm']); entry['has_cover']=bool(entry['has_cover'])
+        entry['exotic']=entry['exotic'].split(';') if entry['exotic'] else []
+        entry['exotic_scanned']=bool(entry['exotic_scanned'])
+        return entry
+
+    def set_file(self, path: str, mtime_ns: int, size: int, mbid: str, rating, votes, popm: bool,
+                 artist, title, duration_ms, has_cover: bool, exotic: list, exotic_scanned: bool = True):
+        """`exotic` : tags exotiques restant dans le fichier ; `exotic_scanned` : False si le scan n'a pas tourné."""
         if self.mode=='ro': return
-        q=self.key(artist,title,duration_ms)
-        c=self.conn.cursor(); c.execute(
-            INSERT INTO search_map(qkey,mbid,fetched_at)
-            VALUES(?,?,?)
-            ON CONFLICT(qkey) DO UPDATE SET mbid=excluded.mbid, fetched_at=excluded.fetched_at
-        ,(q,mbid,int(time.time())))
-        self.conn.commit()
+        with self._lock:
+            self._cur.execute('INSERT OR REPLACE INTO files(path,mtime_ns,size,'+','.join(self._FILE_COLS)+') VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                              (path,mtime_ns,size,mbid,rating,votes,int(bool(popm)),artist,title,duration_ms,int(bool(has_cover)),
+                               ';'.join(exotic or []),int(bool(exotic_scanned))))
+            self._wrote()
+
+    # Réponses HTTP MusicBrainz brutes (corps JSON + ETag) pour _safe_get
+    def get_http(self, key: str):
+        """Retourne (etag, body, frais) ou None ; une entrée périmée reste utilisable pour If-None-Match."""
+        with self._lock:
+            c=self._cur; c.execute('SELECT etag,body,fetched_at FROM http_cache WHERE key=?',(key,))
+            r=c.fetchone();
+        if not r: return None
+        etag,body,ts=r
+        fresh = self.mode=='ro' or (self.mode!='refresh' and (time.time()-ts)<=self.ttl)
+        return etag, body, fresh
+
+    def set_http(self, key: str, etag, body: bytes):
+        if self.mode=='ro': return
+        with self._lock:
+            self._cur.execute('INSERT OR REPLACE INTO http_cache(key,etag,body,fetched_at) VALUES(?,?,?,?)',(key,etag,body,int(time.time())))
+            self._wrote()
+
+    def touch_http(self, key: str):
+        if self.mode=='ro': return
+        with self._lock:
+            self._cur.execute('UPDATE http_cache SET fetched_at=? WHERE key=?',(int(time.time()),key))
+            self._wrote()
 
     def close(self):
+        try: self.flush()
+        except: pass
         try: self.conn.close()
         except: pass
@@ -1,102 +1,127 @@
 
 # exotic_cleanup.py
-import os
-from mutagen.id3 import ID3, ID3NoHeaderError
+import os, re
+from mutagen.id3 import ID3NoHeaderError
 from mutagen.flac import FLAC
 from mutagen.oggvorbis import OggVorbis
 from mutagen.oggopus import OggOpus
 from mutagen.mp4 import MP4
 
-STANDARD_TAGS_ID3 = {
+from utils_mb import load_id3
+
+STANDARD_TAGS_ID3 = frozenset({
     'TIT2','TALB','TPE1','TPE2','TPE3','TPE4','TCON','TDRC','TRCK','TPOS','TCOM','TEXT','TBPM',
     'TSOA','TSOP','TSOT','TSO2','TSRC','TKEY','TENC','COMM','USLT','APIC','PCNT','POPM','PRIV','UFID','WXXX','TXXX'
-}
-ALLOWED_TXXX_DESCS = {
+})
+ALLOWED_TXXX_DESCS = frozenset({
     'RATING','MUSICBRAINZ_RATING','MUSICBRAINZ_RATING_VOTES',
     'MusicBrainz Track Id','MusicBrainz Recording Id','MusicBrainz Release Id',
     'MusicBrainz Release Group Id','MusicBrainz Album Id','MusicBrainz Artist Id',
     'MusicBrainz Album Artist Id','Acoustid Id','Acoustid Fingerprint','ReplayGain','REPLAYGAIN_TRACK_GAIN','REPLAYGAIN_ALBUM_GAIN','REPLAYGAIN_TRACK_PEAK','REPLAYGAIN_ALBUM_PEAK'
-}
-STANDARD_TAGS_VORBIS = {
+})
+_ALLOWED_TXXX_LOWER = frozenset(d.lower() for d in ALLOWED_TXXX_DESCS)
+STANDARD_TAGS_VORBIS = frozenset({
     'ARTIST','ALBUM','TITLE','ALBUMARTIST','TRACKNUMBER','TRACKTOTAL','DISCNUMBER','DISCTOTAL','GENRE','DATE','ORIGINALDATE','ORIGINALYEAR','COMMENT','LYRICS','BARCODE','CATALOGNUMBER','ISRC','SCRIPT','LANGUAGE','RATING','MUSICBRAINZ_RATING','MUSICBRAINZ_RATING_VOTES'
-}
+})
 ALLOWED_VORBIS_PREFIXES = ('MUSICBRAINZ_','ACOUSTID','REPLAYGAIN')
-STANDARD_TAGS_MP4 = {'©ART','©alb','©nam','©day','©gen','trkn','disk','aART','cpil','tmpo'}
+STANDARD_TAGS_MP4 = frozenset({'©ART','©alb','©nam','©day','©gen','trkn','disk','aART','cpil','tmpo'})
 ALLOWED_MP4_FREEFORM_KEYWORDS = ('musicbrainz','acoustid','rating','replaygain')
+_VORBIS_PREFIX_RE = re.compile('^(?:' + '|'.join(map(re.escape, ALLOWED_VORBIS_PREFIXES)) + ')')
+_MP4_FREEFORM_RE = re.compile('|'.join(map(re.escape, ALLOWED_MP4_FREEFORM_KEYWORDS)))
 
 
-def analyze_tags_and_cover(audio, path: str):
-    ext = os.path.splitext(path)[1].lower()
+def analyze_tags_and_cover(audio, path: str, ext: str = None, need_exotic: bool = True, need_cover: bool = True):
+    """Retourne (tags exotiques, pochette présente). Avec need_exotic=False le
+    classement des tags est sauté et la liste est vide ; avec need_cover=False la pochette vaut False.
+    """
+    if ext is None: ext = os.path.splitext(path)[1].lower()
     if ext == '.mp3':
-        try: id3 = ID3(path)
+        try: id3 = load_id3(audio, path)
         except ID3NoHeaderError: return [], False
-        exotic = []
-        cover = any(id3.getall('APIC'))
+        cover = need_cover and bool(id3.getall('APIC'))
+        if not need_exotic: return [], cover
+        exotic = []; exotic_append = exotic.append; _std = STANDARD_TAGS_ID3
         for f in id3.values():
-            if f.FrameID not in STANDARD_TAGS_ID3:
-                exotic.append(f.FrameID)
+            fid = f.FrameID
+            if fid not in _std: exotic_append(fid)
         return exotic, cover
     if isinstance(audio,(FLAC,OggVorbis,OggOpus)):
+        cover = need_cover and bool(getattr(audio,'pictures',None))
+        if not need_exotic: return [], cover
         exotic=[]; tags=(audio.tags or {}).keys()
+        _std=STANDARD_TAGS_VORBIS; _allowed=_VORBIS_PREFIX_RE.match
         for k in tags:
             ku=k.upper()
-            if ku in STANDARD_TAGS_VORBIS: continue
-            if any(ku.startswith(p) for p in ALLOWED_VORBIS_PREFIXES): continue
+            if ku in _std or _allowed(ku): continue
             exotic.append(k)
-        cover = hasattr(audio,'pictures') and bool(audio.pictures)
         return exotic, cover
     if isinstance(audio, MP4):
+        cover = need_cover and 'covr' in (audio.tags or {})
+        if not need_exotic: return [], cover
         exotic=[]
+        _std=STANDARD_TAGS_MP4; _allowed=_MP4_FREEFORM_RE.search
         for k in (audio.tags or {}).keys():
-            if k in STANDARD_TAGS_MP4: continue
-            if k.lower().startswith('----:'):
-                if any(kw in k.lower() for kw in ALLOWED_MP4_FREEFORM_KEYWORDS):
-                    continue
+            if k in _std: continue
+            kl=k.lower()
+            if kl.startswith('----:') and _allowed(kl): continue
             exotic.append(k)
-        cover = 'covr' in (audio.tags or {})
         return exotic, cover
     return [], False
 
 
-def remove_exotic_tags(audio, path: str, mode: str, allow_txxx: set, allow_vorbis: set, allow_mp4: set):
-    ext = os.path.splitext(path)[1].lower()
+def remove_exotic_tags(audio, path: str, mode: str, allow_txxx: set, allow_vorbis: set, allow_mp4: set, ext: str = None,
+                       save: bool = True, id3=None):
+    """Supprime les tags exotiques en place et sauve. Retourne (supprimés, audio) : l'objet reste à jour, inutile de relire le fichier.
+    Avec save=False rien n'est écrit : l'appelant sauve une seule fois (utils_mb.commit_tags) avec les notes.
+    allow_* : frozensets de noms en minuscules (voir mb_rating_tag._allow_set), comparés sans tenir compte de la casse.
+    """
+    if ext is None: ext = os.path.splitext(path)[1].lower()
     removed=[]
     if ext=='.mp3':
-        try: id3=ID3(path)
-        except ID3NoHeaderError: return removed
+        if id3 is None:
+            try: id3=load_id3(audio, path)
+            except ID3NoHeaderError: return removed, audio
+        _std=STANDARD_TAGS_ID3; _delall=id3.delall
         for f in list(id3.values()):
-            if f.FrameID not in STANDARD_TAGS_ID3 and f.FrameID!='TXXX':
-                id3.delall(f.FrameID); removed.append(f.FrameID)
+            fid=f.FrameID
+            if fid not in _std and fid!='TXXX':
+                _delall(fid); removed.append(fid)
         if mode=='strict':
             keep=[]
             for f in id3.getall('TXXX'):
-                d=f.desc or ''
-                if d in ALLOWED_TXXX_DESCS or d in allow_txxx:
+                d=f.desc or ''; dl=d.lower()
+                if dl in _ALLOWED_TXXX_LOWER or dl in allow_txxx:
                     keep.append(f)
                 else:
                     removed.append('TXXX:'+d)
             id3.setall('TXXX', keep)
-        id3.save(v2_version=3); return removed
+        if save: id3.save(path, v2_version=3)
+        return removed, audio
     if isinstance(audio,(FLAC,OggVorbis,OggOpus)):
+        _std=STANDARD_TAGS_VORBIS; _allowed=_VORBIS_PREFIX_RE.match
         for k in list((audio.tags or {}).keys()):
             ku=k.upper()
-            if ku in STANDARD_TAGS_VORBIS or any(ku.startswith(p) for p in ALLOWED_VORBIS_PREFIXES):
+            if ku in _std or _allowed(ku):
                 continue
-            if k in allow_vorbis: continue
+            if allow_vorbis and k.lower() in allow_vorbis: continue
             try:
                 del audio.tags[k]; removed.append(k)
             except: pass
-        audio.save(); return removed
+        if save: audio.save()
+        return removed, audio
     if isinstance(audio, MP4):
+        _std=STANDARD_TAGS_MP4; _allowed=_MP4_FREEFORM_RE.search
         for k in list((audio.tags or {}).keys()):
-            if k in STANDARD_TAGS_MP4: continue
-            if k in allow_mp4: continue
-            if k.lower().startswith('----:'):
-                keep_free = any(kw in k.lower() for kw in ALLOWED_MP4_FREEFORM_KEYWORDS)
+            if k in _std: continue
+            kl=k.lower()
+            if kl in allow_mp4: continue
+            if kl.startswith('----:'):
+                keep_free = _allowed(kl) is not None
                 if mode=='conservative' and keep_free: continue
                 if mode=='strict' and keep_free: continue
             try:
                 del audio.tags[k]; removed.append(k)
             except: pass
-        audio.save(); return removed
-    return removed
+        if save: audio.save()
+        return removed, audio
+    return removed, audio
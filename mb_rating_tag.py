@@ -4,15 +4,18 @@
 """
 mb_rating_tag.py — Script principal (ULTRA-SAFE + fallback release-group)
 """
-import os, argparse
+import os, sys, argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from mutagen import File
+from mutagen.id3 import ID3, ID3NoHeaderError
 
 from utils_mb import (
-    write_log, iter_audio_files, extract_mb_recording_id, extract_basic_identity,
+    write_log, open_log, close_log, set_http_cache, iter_audio_files, extract_mb_recording_id, extract_basic_identity,
     mb_get_recording_rating, mb_search_recording, write_rating_generic,
     mb_get_first_release_id_for_recording, mb_get_release_group_id, mb_get_release_group_rating,
-    write_rg_rating_tags
+    write_rg_rating_tags, load_id3, commit_tags
 )
 from cache import MbCache
 from exotic_cleanup import analyze_tags_and_cover, remove_exotic_tags
@@ -25,9 +28,12 @@ def process_file(path: str, root: str, ua: str,
                  remove_exotic: bool, exotic_mode: str,
                  allow_txxx: set, allow_vorbis: set, allow_mp4: set,
                  do_backup: bool, do_restore: bool, backup_dir: str,
-                 cache: 'MbCache|None' = None) -> dict:
+                 cache: 'MbCache|None' = None, pic_cache: 'set|None' = None,
+                 scan_exotic: bool = True) -> dict:
 
     rel = os.path.relpath(path, root) if os.path.isdir(root) else os.path.basename(path)
+    ext = os.path.splitext(path)[1].lower()
+    need_exotic = remove_exotic or scan_exotic
     result = {
         'file': rel, 'status': 'skip', 'mbid': None, 'mbid_rg': None, 'fallback': None,
         'rating': None, 'votes': None,
@@ -36,114 +42,161 @@ def process_file(path: str, root: str, ua: str,
     }
 
     try:
+        # Fichier inchangé depuis un run précédent et note en cache identique : rien à relire ni à écrire
+        if cache and not (do_backup or do_restore or remove_exotic or dry_run):
+            st = os.stat(path)
+            entry = cache.get_file(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+            # Entrée écrite sans scan exotique : inutilisable si ce run le demande
+            if entry and entry['popm'] == bool(write_popm) and (entry['exotic_scanned'] or not need_exotic):
+                value_votes = cache.get_rating(entry['mbid'])
+                if value_votes and value_votes[0] is not None and (float(value_votes[0]), value_votes[1]) == (entry['rating'], entry['votes']):
+                    rating, votes = value_votes
+                    result.update({'mbid': entry['mbid'], 'rating': float(rating), 'votes': votes,
+                                   'artist': entry['artist'], 'title': entry['title'], 'duration_ms': entry['duration_ms'],
+                                   'has_cover': entry['has_cover'], 'exotic_tags': entry['exotic'] if need_exotic else []})
+                    msg=f"MBID={entry['mbid']} rating={rating} votes={votes} (inchangé)"; write_log('ok', rel, msg)
+                    result.update({'status':'ok','message':msg}); return result
+
         audio = File(path, easy=False)
         if audio is None:
             msg='Non audio ou format non supporté'; write_log('skip', rel, msg)
             result.update({'status':'skip','message':msg}); return result
 
         if do_restore:
-            ok,msg = restore_tags(path, rel, backup_dir)
+            ok,msg = restore_tags(path, rel, backup_dir, audio=audio)
             write_log('restore', rel, msg)
             result.update({'status':'restore','message':msg})
-            audio2 = File(path, easy=False)
-            ex2, cov2 = analyze_tags_and_cover(audio2, path)
+            ex2, cov2 = analyze_tags_and_cover(audio, path, ext=ext, need_exotic=need_exotic)
             result.update({'exotic_tags': ex2, 'has_cover': cov2})
             return result
 
-        exotic, has_cover = analyze_tags_and_cover(audio, path)
+        exotic, has_cover = analyze_tags_and_cover(audio, path, ext=ext, need_exotic=need_exotic)
         result['exotic_tags'] = exotic; result['has_cover'] = has_cover
 
         if do_backup:
-            bpath = backup_tags(audio, path, rel, backup_dir)
+            bpath = backup_tags(audio, path, rel, backup_dir, ext=ext, pic_cache=pic_cache)
             write_log('backup', rel, f'Backup: {bpath}')
             result['backup'] = bpath
 
+        # ID3 lu une seule fois (audio.tags) et partagé par les helpers de lecture/écriture
+        id3 = None
+        if ext == '.mp3':
+            try: id3 = load_id3(audio, path)
+            except ID3NoHeaderError: id3 = ID3()
+        # Nettoyage appliqué en mémoire ; sauvé avec les notes (une seule écriture) ou dans le finally
+        dirty = False
         if remove_exotic and exotic:
             if dry_run:
                 write_log('plan-clean', rel, f"Suppression prévue ({exotic_mode}) : {', '.join(exotic)}")
                 result['removed_exotic'] = exotic[:]
             else:
-                removed = remove_exotic_tags(audio, path, exotic_mode, allow_txxx, allow_vorbis, allow_mp4)
+                removed, audio = remove_exotic_tags(audio, path, exotic_mode, allow_txxx, allow_vorbis, allow_mp4, ext=ext,
+                                                    save=False, id3=id3)
+                dirty = bool(removed)
                 if removed:
                     write_log('clean', rel, f"Supprimés ({exotic_mode}) : {', '.join(removed)}")
                 result['removed_exotic'] = removed
-                audio = File(path, easy=False)
-
-        mbid = extract_mb_recording_id(audio, path)
-        artist, title, duration_ms = extract_basic_identity(audio, path)
-        result.update({'artist':artist,'title':title,'duration_ms':duration_ms})
-
-        value_votes = None
-        if mbid and cache:
-            value_votes = cache.get_rating(mbid)
-        if not mbid and cache:
-            cached_mbid = cache.get_search_mbid(artist, title, duration_ms)
-            if cached_mbid:
-                mbid = cached_mbid
-
-        if not mbid and not (search_fallback and artist and title):
-            msg='Aucun MBID et infos insuffisantes pour recherche'; write_log('skip', rel, msg)
-            result.update({'status':'skip','message':msg}); return result
 
-        if mbid:
-            if not value_votes:
-                value_votes = mb_get_recording_rating(mbid, ua)
-                if cache and value_votes is not None:
-                    cache.set_rating(mbid, value_votes[0], value_votes[1])
-        else:
-            mbid = mb_search_recording(artist or '', title or '', duration_ms, ua)
-            if cache and mbid:
-                cache.set_search_mbid(artist, title, duration_ms, mbid)
-            if not mbid:
-                msg=f'Recherche sans résultat pour {artist} - {title}'; write_log('not-found', rel, msg)
-                result.update({'status':'not-found','message':msg}); return result
-            value_votes = cache.get_rating(mbid) if cache else None
-            if not value_votes:
-                value_votes = mb_get_recording_rating(mbid, ua)
-                if cache and value_votes is not None:
-                    cache.set_rating(mbid, value_votes[0], value_votes[1])
-
-        result['mbid'] = mbid
-        if value_votes and value_votes[0] is not None:
-            rating, votes = value_votes
-            result['rating']=float(rating); result['votes']=votes
-            if dry_run:
-                msg=f'(dry-run) MBID={mbid} rating={rating} votes={votes}'; write_log('ok(dry)', rel, msg)
-                result.update({'status':'ok(dry)','message':msg}); return result
-            write_rating_generic(audio, path, float(rating), votes, write_popm)
-            msg=f'MBID={mbid} rating={rating} votes={votes}'; write_log('ok', rel, msg)
-            result.update({'status':'ok','message':msg}); return result
-
-        # ---------- FALLBACK : release-group ----------
-        release_id = mb_get_first_release_id_for_recording(mbid, ua)
-        if release_id:
-            rgid = mb_get_release_group_id(release_id, ua)
-            if rgid:
-                rg_rating = mb_get_release_group_rating(rgid, ua)
-                if rg_rating and rg_rating[0] is not None:
-                    rg_value, rg_votes = rg_rating
-                    result['mbid_rg'] = rgid
-                    result['fallback'] = 'release-group'
-                    result['rating'] = float(rg_value)
-                    result['votes'] = rg_votes
-                    if dry_run:
-                        msg=f'(dry-run) FALLBACK RG: MBID_RG={rgid} rating={rg_value} votes={rg_votes}'
-                        write_log('ok(dry)', rel, msg)
-                        result.update({'status':'ok(dry)','message':msg}); return result
-                    write_rg_rating_tags(audio, path, float(rg_value), rg_votes)
-                    msg=f'FALLBACK RG: MBID_RG={rgid} rating={rg_value} votes={rg_votes}'
-                    write_log('ok', rel, msg)
-                    result.update({'status':'ok','message':msg}); return result
+        try:
+            mbid = extract_mb_recording_id(audio, path, id3=id3)
+            artist, title, duration_ms = extract_basic_identity(audio, path, id3=id3)
+            result.update({'artist':artist,'title':title,'duration_ms':duration_ms})
+
+            value_votes = None
+            qkey = None
+            if not mbid and cache:
+                # Clé de recherche calculée seulement sans MBID embarqué
+                qkey = MbCache.key(artist, title, duration_ms)
+                mbid = cache.get_search_mbid_by_key(qkey)
+            if mbid and cache:
+                value_votes = cache.get_rating(mbid)
 
-        msg = f"Aucune note pour MBID {mbid} (ni recording ni release-group)"
-        write_log('not-found', rel, msg)
-        result.update({'status':'not-found','message':msg}); return result
+            if not mbid and not (search_fallback and artist and title):
+                msg='Aucun MBID et infos insuffisantes pour recherche'; write_log('skip', rel, msg)
+                result.update({'status':'skip','message':msg}); return result
+
+            if mbid:
+                if not value_votes:
+                    value_votes = mb_get_recording_rating(mbid, ua)
+                    if cache and value_votes is not None:
+                        cache.set_rating(mbid, value_votes[0], value_votes[1])
+            else:
+                mbid = mb_search_recording(artist or '', title or '', duration_ms, ua)
+                if cache and mbid:
+                    cache.set_search_mbid_by_key(qkey, mbid)
+                if not mbid:
+                    msg=f'Recherche sans résultat pour {artist} - {title}'; write_log('not-found', rel, msg)
+                    result.update({'status':'not-found','message':msg}); return result
+                value_votes = cache.get_rating(mbid) if cache else None
+                if not value_votes:
+                    value_votes = mb_get_recording_rating(mbid, ua)
+                    if cache and value_votes is not None:
+                        cache.set_rating(mbid, value_votes[0], value_votes[1])
+
+            result['mbid'] = mbid
+            if value_votes and value_votes[0] is not None:
+                rating, votes = value_votes
+                result['rating']=float(rating); result['votes']=votes
+                if dry_run:
+                    msg=f'(dry-run) MBID={mbid} rating={rating} votes={votes}'; write_log('ok(dry)', rel, msg)
+                    result.update({'status':'ok(dry)','message':msg}); return result
+                write_rating_generic(audio, path, float(rating), votes, write_popm, id3=id3); dirty = False
+                if cache:
+                    st = os.stat(path)
+                    cache.set_file(os.path.abspath(path), st.st_mtime_ns, st.st_size, mbid, float(rating), votes, write_popm,
+                                   artist, title, duration_ms, result['has_cover'],
+                                   [t for t in result['exotic_tags'] if t not in result['removed_exotic']], need_exotic)
+                msg=f'MBID={mbid} rating={rating} votes={votes}'; write_log('ok', rel, msg)
+                result.update({'status':'ok','message':msg}); return result
+
+            # ---------- FALLBACK : release-group ----------
+            release_id = mb_get_first_release_id_for_recording(mbid, ua)
+            if release_id:
+                rgid = mb_get_release_group_id(release_id, ua)
+                if rgid:
+                    rg_rating = mb_get_release_group_rating(rgid, ua)
+                    if rg_rating and rg_rating[0] is not None:
+                        rg_value, rg_votes = rg_rating
+                        result['mbid_rg'] = rgid
+                        result['fallback'] = 'release-group'
+                        result['rating'] = float(rg_value)
+                        result['votes'] = rg_votes
+                        if dry_run:
+                            msg=f'(dry-run) FALLBACK RG: MBID_RG={rgid} rating={rg_value} votes={rg_votes}'
+                            write_log('ok(dry)', rel, msg)
+                            result.update({'status':'ok(dry)','message':msg}); return result
+                        write_rg_rating_tags(audio, path, float(rg_value), rg_votes, id3=id3); dirty = False
+                        msg=f'FALLBACK RG: MBID_RG={rgid} rating={rg_value} votes={rg_votes}'
+                        write_log('ok', rel, msg)
+                        result.update({'status':'ok','message':msg}); return result
+
+            msg = f"Aucune note pour MBID {mbid} (ni recording ni release-group)"
+            write_log('not-found', rel, msg)
+            result.update({'status':'not-found','message':msg}); return result
+        finally:
+            if dirty: commit_tags(audio, path, id3)
 
     except Exception as e:
         write_log('error', rel, f"{type(e).__name__}: {e}")
         result.update({'status':'error','message':f"{type(e).__name__}: {e}"}); return result
 
 
+def _bounded_map(ex, fn, paths, window: int):
+    """ex.map à fenêtre bornée : au plus `window` tâches en vol, résultats dans l'ordre.
+    ex.map soumettrait tout d'emblée et garderait chaque résultat jusqu'à sa lecture par le rapport.
+    """
+    pending = deque()
+    for p in paths:
+        pending.append(ex.submit(fn, p))
+        if len(pending) >= window: yield pending.popleft().result()
+    while pending: yield pending.popleft().result()
+
+
+def _allow_set(raw: str) -> frozenset:
+    """Liste 'a;b;c' -> frozenset de noms déjà en minuscules (contrat de remove_exotic_tags)."""
+    return frozenset(sys.intern(s.strip().lower()) for s in raw.split(';') if s.strip())
+
+
 def main():
     p=argparse.ArgumentParser(description='ULTRA-SAFE MusicBrainz rating + log + report + cleanup + backup/restore + cache + RG fallback')
     p.add_argument('path')
@@ -156,6 +209,7 @@ def main():
     p.add_argument('--exotic-allow-txxx', default='')
     p.add_argument('--exotic-allow-vorbis', default='')
     p.add_argument('--exotic-allow-mp4', default='')
+    p.add_argument('--no-exotic-scan', action='store_true')
     p.add_argument('--report', default='')
     p.add_argument('--backup-tags', action='store_true')
     p.add_argument('--restore-tags', action='store_true')
@@ -164,33 +218,44 @@ def main():
     p.add_argument('--cache-db', default='.mbcache.sqlite')
     p.add_argument('--cache-ttl', type=int, default=86400)
     p.add_argument('--cache-mode', choices=['ro','rw','refresh'], default='rw')
+    p.add_argument('--workers', type=int, default=8)
     args=p.parse_args()
 
     if args.restore_tags:
         args.remove_exotic=False; args.write_popm=False; args.dry_run=False
 
-    allow_txxx=set([s for s in args.exotic_allow_txxx.split(';') if s.strip()])
-    allow_vorbis=set([s for s in args.exotic_allow_vorbis.split(';') if s.strip()])
-    allow_mp4=set([s for s in args.exotic_allow_mp4.split(';') if s.strip()])
+    allow_txxx=_allow_set(args.exotic_allow_txxx)
+    allow_vorbis=_allow_set(args.exotic_allow_vorbis)
+    allow_mp4=_allow_set(args.exotic_allow_mp4)
 
     cache=None
     if args.cache:
         cache=MbCache(args.cache_db, mode=args.cache_mode, ttl=args.cache_ttl)
+        set_http_cache(cache)  # réponses MB conservées d'un run à l'autre (ETag)
 
-    started=datetime.now(); results=[]
+    pic_cache=set()  # pochettes déjà sauvegardées pendant ce run (sha1)
+    started=datetime.now()
     target=args.path
+    report_path = args.report or f"mb_rating_report_{started.strftime('%Y%m%d_%H%M%S')}.html"
+    # Les fichiers sont traités en parallèle ; les appels MB restent sérialisés par _rate_limit (utils_mb).
+    # Les chemins sont parcourus à la demande et au plus 2×workers fichiers sont en vol :
+    # la mémoire ne dépend pas de la taille de la bibliothèque, le rapport consomme les résultats au fil de l'eau.
+    run = lambda f: process_file(f, target, args.ua, args.write_popm, args.search_fallback, args.dry_run,
+                                 args.remove_exotic, args.exotic_mode, allow_txxx, allow_vorbis, allow_mp4,
+                                 args.backup_tags, args.restore_tags, args.backup_dir, cache, pic_cache,
+                                 not args.no_exotic_scan)
+    open_log()
     try:
-        for f in iter_audio_files(target):
-            res=process_file(f, target, args.ua, args.write_popm, args.search_fallback, args.dry_run,
-                             args.remove_exotic, args.exotic_mode, allow_txxx, allow_vorbis, allow_mp4,
-                             args.backup_tags, args.restore_tags, args.backup_dir, cache)
-            results.append(res)
+        # Un seul fichier ou --workers 1 : pas de pool, traitement direct
+        if args.workers <= 1 or os.path.isfile(target):
+            generate_html_report(map(run, iter_audio_files(target)), started, None, report_path)
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers) as ex:
+                generate_html_report(_bounded_map(ex, run, iter_audio_files(target), 2*args.workers), started, None, report_path)
     finally:
+        close_log()
         if cache: cache.close()
 
-    ended=datetime.now()
-    report_path = args.report or f"mb_rating_report_{ended.strftime('%Y%m%d_%H%M%S')}.html"
-    generate_html_report(results, started, ended, report_path)
     print('Terminé. Log: mb_rating_tag.log')
     print(f'Report: {report_path}')
 
@@ -1,18 +1,28 @@
 
 # report_html.py
-import base64
+try:
+    import pybase64 as _b64
+except ImportError:
+    import base64 as _b64
+import codecs, csv, json, shutil
 from datetime import datetime
+from functools import lru_cache
+from html import escape as _html_escape
+from tempfile import SpooledTemporaryFile
 
 def fmt_ms(ms):
     if not ms: return ''
-    s=int(round(ms/1000)); m,s=divmod(s,60); h,m=divmod(m,60)
-    return f"{h:02d}:{m:02d}:{s:02d}" if h else f"{m:02d}:{s:02d}"
+    return _fmt_ms(int(ms))
 
-def _esc(s):
-    import html
-    return html.escape('' if s is None else str(s))
+@lru_cache(maxsize=8192)  # beaucoup de pistes partagent la même durée à la seconde près
+def _fmt_ms(ms):
+    # Arrondi entier au plus proche, égalité vers le pair comme round(ms/1000)
+    s,r=divmod(ms,1000)
+    if r>500 or (r==500 and s&1): s+=1
+    m,s=divmod(s,60); h,m=divmod(m,60)
+    return f"{h:02d}:{m:02d}:{s:02d}" if h else f"{m:02d}:{s:02d}"
 
-_CSS = ":root { color-scheme: light dark; }
+_CSS = """:root { color-scheme: light dark; }
 body { font-family: system-ui, -apple-system, Segoe UI, Roboto, Arial, sans-serif; margin:24px; }
 header { margin-bottom: 16px; }
 h1 { font-size: 22px; margin:0 0 8px 0; }
@@ -24,109 +34,128 @@ th,td { border-bottom:1px solid #eee; padding:6px; text-align:left; }
 th { position:sticky; top:0; background:canvas; }
 tr:hover { background: rgba(0,0,0,.03); }
 .note { color:#666; font-size:12px; }
-"
+#wrap { max-height:75vh; overflow:auto; }
+#tbl td { white-space:nowrap; overflow:hidden; text-overflow:ellipsis; max-width:28em; }
+"""
+
+_CSV_HEADER = ("file","status","mbid","mbid_rg","fallback","rating","votes","artist","title","duration","has_cover","exotic_tags","removed_exotic","message")
+_B64_CHUNK = 48*1024  # multiple de 3 : les morceaux encodés se concatènent sans padding
+_SPOOL_MAX = 8*1024*1024
+
+# Rendu virtualisé : les résultats sont un tableau JSON, seules les lignes visibles sont dans le DOM.
+# Colonnes de chaque ligne : statut, fichier, artiste, titre, note, votes, durée, MBID, MBID RG,
+# fallback, tags exotiques, supprimés, pochette (0/1), message.
+_JS = """
+(function(){
+  const data=JSON.parse(document.getElementById('data').textContent);
+  const hay=data.map(r=>[r[1],r[2],r[3],r[0],r[7],r[8]].join(' ').toLowerCase());
+  const q=document.getElementById('q'), wrap=document.getElementById('wrap');
+  const tbody=document.querySelector('#tbl tbody');
+  const MARGIN=20;
+  let visible=data.map((_,i)=>i), rowH=0, pending=false;
+  const ENT={'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'};
+  function esc(s){return s==null?'':String(s).replace(/[&<>"']/g,c=>ENT[c]);}
+  function rowHtml(r){
+    let h="<tr data-status='"+esc(r[0])+"'>";
+    for(let j=0;j<12;j++) h+='<td>'+esc(r[j])+'</td>';
+    return h+'<td>'+(r[12]?'✔️':'❌')+"</td><td class='note' title='"+esc(r[13])+"'>"+esc(r[13])+'</td></tr>';
+  }
+  function render(){
+    pending=false;
+    const h=rowH||24, top=wrap.scrollTop;
+    const first=Math.max(0,Math.floor(top/h)-MARGIN);
+    const last=Math.min(visible.length,Math.ceil((top+wrap.clientHeight)/h)+MARGIN);
+    let html="<tr style='height:"+(first*h)+"px'></tr>";
+    for(let i=first;i<last;i++) html+=rowHtml(data[visible[i]]);
+    html+="<tr style='height:"+((visible.length-last)*h)+"px'></tr>";
+    tbody.innerHTML=html;
+    if(!rowH&&last>first){rowH=tbody.rows[1].offsetHeight||24; render();}
+  }
+  function schedule(){if(!pending){pending=true; requestAnimationFrame(render);}}
+  q.addEventListener('input',()=>{
+    const qq=q.value.toLowerCase(); visible=[];
+    for(let i=0;i<hay.length;i++) if(!qq||hay[i].includes(qq)) visible.push(i);
+    wrap.scrollTop=0; schedule();
+  });
+  wrap.addEventListener('scroll',schedule);
+  render();
+})();
+"""
 
 def generate_html_report(results, started: datetime, ended: datetime, output_path: str):
-    total=len(results)
-    ok=sum(1 for r in results if str(r.get('status','')).startswith('ok'))
-    restored=sum(1 for r in results if r.get('status')=='restore')
-    errors=sum(1 for r in results if r.get('status')=='error')
-    skipped=sum(1 for r in results if r.get('status')=='skip')
-    not_found=sum(1 for r in results if r.get('status')=='not-found')
-    cleaned=sum(1 for r in results if (r.get('removed_exotic') or []) and str(r.get('status','')).startswith('ok'))
-    ratings=[r['rating'] for r in results if r.get('rating') is not None]
-    avg=sum(ratings)/len(ratings) if ratings else 0.0
+    """Écrit le rapport en un seul passage sur `results` (liste ou générateur).
+    Les lignes HTML et le CSV transitent par des fichiers temporaires, la mémoire reste bornée.
+    Si `ended` vaut None, l'heure de fin est prise une fois `results` épuisé.
+    """
+    total=ok=restored=errors=skipped=not_found=cleaned=0
+    ratings_sum=0.0; ratings_n=0
 
-    def esc_csv(s):
-        if s is None: return ''
-        s=str(s)
-        if any(c in s for c in [',','"','
-']):
-            return '"'+s.replace('"','""')+'"'
-        return s
+    with SpooledTemporaryFile(max_size=_SPOOL_MAX, mode='w+b') as rows_f, \
+         SpooledTemporaryFile(max_size=_SPOOL_MAX, mode='w+b') as csv_f:
+        # csv.writer (C), encodé en UTF-8 vers le spool ; fins de ligne \r\n (RFC 4180) : les \r et \n des cellules sont mis entre guillemets
+        csv_w=csv.writer(codecs.getwriter('utf-8')(csv_f), quoting=csv.QUOTE_MINIMAL, lineterminator='\r\n')
+        csv_row=csv_w.writerow
+        csv_row(_CSV_HEADER)
+        for r in results:
+            g=r.get
+            status=g('status'); file=g('file'); artist=g('artist'); title=g('title')
+            rating=g('rating'); votes=g('votes'); mbid=g('mbid'); mbid_rg=g('mbid_rg'); fallback=g('fallback')
+            exotic=g('exotic_tags') or []; removed=g('removed_exotic') or []; has_cover=g('has_cover'); message=g('message')
+            duration=fmt_ms(g('duration_ms'))
 
-    csv_lines=["file,status,mbid,mbid_rg,fallback,rating,votes,artist,title,duration,has_cover,exotic_tags,removed_exotic,message"]
-    for r in results:
-        csv_lines.append(','.join([
-            esc_csv(r.get('file')), esc_csv(r.get('status')), esc_csv(r.get('mbid')),
-            esc_csv(r.get('mbid_rg')), esc_csv(r.get('fallback')),
-            esc_csv(r.get('rating')), esc_csv(r.get('votes')),
-            esc_csv(r.get('artist')), esc_csv(r.get('title')),
-            esc_csv(fmt_ms(r.get('duration_ms'))), esc_csv('yes' if r.get('has_cover') else 'no'),
-            esc_csv(';'.join(r.get('exotic_tags') or [])), esc_csv(';'.join(r.get('removed_exotic') or [])), esc_csv(r.get('message'))
-        ]))
-    csv_b64=base64.b64encode('
-'.join(csv_lines).encode('utf-8')).decode('ascii')
+            total+=1
+            if (status if isinstance(status, str) else str(status or '')).startswith('ok'):
+                ok+=1
+                if removed: cleaned+=1
+            elif status=='restore': restored+=1
+            elif status=='error': errors+=1
+            elif status=='skip': skipped+=1
+            elif status=='not-found': not_found+=1
+            if rating is not None:
+                ratings_sum+=rating; ratings_n+=1
 
-    started_s=started.strftime('%Y-%m-%d %H:%M:%S'); ended_s=ended.strftime('%Y-%m-%d %H:%M:%S')
+            csv_row((file, status, mbid, mbid_rg, fallback, rating, votes, artist, title, duration,
+                     'yes' if has_cover else 'no', ';'.join(exotic), ';'.join(removed), message))
 
-    rows=[]
-    for r in results:
-        rating_str = f"{r.get('rating'):.1f}" if r.get('rating') is not None else ''
-        cover_str = '✔️' if r.get('has_cover') else '❌'
-        exotic_str = ', '.join(r.get('exotic_tags') or [])
-        removed_str = ', '.join(r.get('removed_exotic') or [])
-        rows.append(
-            "<tr data-status='{status}'>"
-            "<td>{status}</td><td>{file}</td><td>{artist}</td><td>{title}</td>"
-            "<td>{rating}</td><td>{votes}</td><td>{duration}</td>"
-            "<td>{mbid}</td><td>{mbid_rg}</td><td>{fallback}</td>"
-            "<td>{exotic}</td><td>{removed}</td><td>{cover}</td><td class='note'>{message}</td>"
-            "</tr>".format(
-                status=_esc(r.get('status')),
-                file=_esc(r.get('file')),
-                artist=_esc(r.get('artist')),
-                title=_esc(r.get('title')),
-                rating=_esc(rating_str),
-                votes=_esc(r.get('votes')),
-                duration=_esc(fmt_ms(r.get('duration_ms'))),
-                mbid=_esc(r.get('mbid')),
-                mbid_rg=_esc(r.get('mbid_rg')),
-                fallback=_esc(r.get('fallback')),
-                exotic=_esc(exotic_str),
-                removed=_esc(removed_str),
-                cover=_esc(cover_str),
-                message=_esc(r.get('message')),
-            )
-        )
-    rows_html='
-'.join(rows)
+            rating_str = f"{rating:.1f}" if rating is not None else ''
+            row = json.dumps([status, file, artist, title, rating_str, votes, duration, mbid, mbid_rg, fallback,
+                              ', '.join(exotic), ', '.join(removed), 1 if has_cover else 0, message],
+                             ensure_ascii=False, separators=(',',':'), default=str)
+            # '<' échappé : le JSON ne peut pas refermer la balise <script> qui le contient
+            rows_f.write(((',' if total>1 else '') + row.replace('<','\\u003c') + '\n').encode('utf-8'))
 
-    html_head = (
-        "<!doctype html><html lang='fr'><head><meta charset='utf-8'>"
-        "<title>Rapport MusicBrainz</title><style>" + _CSS + "</style></head><body>"
-    )
-    html_header = (
-        "<header><h1>Rapport — intégration des notes MusicBrainz</h1>"
-        "<div class='meta'>Début: {start} · Fin: {end} · Fichiers: {total} · Succès: {ok} · Restaurés: {rest} · "
-        "Nettoyés: {clean} · Sans note: {nf} · Erreurs: {err} · Ignorés: {skip} · Note moyenne: {avg:.2f}</div>"
-        "</header>".format(start=_esc(started_s), end=_esc(ended_s), total=total, ok=ok, rest=restored, clean=cleaned, nf=not_found, err=errors, skip=skipped, avg=avg)
-    )
-    html_toolbar = (
-        "<div class='toolbar'>"
-        "<input id='q' type='search' placeholder='Filtrer (fichier, artiste, titre, statut, MBID)…'>"
-        f"data:text/csv;base64,{csv_b64}Exporter CSV</a>"
-        "</div>"
-    )
-    html_table = (
-        "<table id='tbl'><thead><tr>"
-        "<th>Statut</th><th>Fichier</th><th>Artiste</th><th>Titre</th><th>Note</th><th>Votes</th><th>Durée</th>"
-        "<th>MBID</th><th>MBID RG</th><th>Fallback RG</th><th>Tags exotiques</th><th>Supprimés</th><th>Pochette</th><th>Message</th>"
-        "</tr></thead><tbody>" + rows_html + "</tbody></table>"
-    )
-    _JS = """
-(function(){
-  const q=document.getElementById('q');
-  const rows=Array.from(document.querySelectorAll('#tbl tbody tr'));
-  function norm(s){return (s||'').toLowerCase();}
-  function apply(){
-    const qq=norm(q.value);
-    rows.forEach(tr=>{const ok=!qq||norm(tr.innerText).includes(qq); tr.style.display=ok?'':'none';});
-  }
-  q.addEventListener('input', apply);
-})();
-"""
-    html_js = "<script>" + _JS + "</script>"
-    html = html_head + html_header + html_toolbar + html_table + html_js + "</body></html>"
-    with open(output_path,'w',encoding='utf-8') as f:
-        f.write(html)
+        if ended is None: ended=datetime.now()
+        avg=ratings_sum/ratings_n if ratings_n else 0.0
+        started_s=started.strftime('%Y-%m-%d %H:%M:%S'); ended_s=ended.strftime('%Y-%m-%d %H:%M:%S')
+
+        html_head = (
+            "<!doctype html><html lang='fr'><head><meta charset='utf-8'>"
+            "<title>Rapport MusicBrainz</title><style>" + _CSS + "</style></head><body>"
+        )
+        html_header = (
+            "<header><h1>Rapport — intégration des notes MusicBrainz</h1>"
+            "<div class='meta'>Début: {start} · Fin: {end} · Fichiers: {total} · Succès: {ok} · Restaurés: {rest} · "
+            "Nettoyés: {clean} · Sans note: {nf} · Erreurs: {err} · Ignorés: {skip} · Note moyenne: {avg:.2f}</div>"
+            "</header>".format(start=_html_escape(started_s), end=_html_escape(ended_s), total=total, ok=ok, rest=restored, clean=cleaned, nf=not_found, err=errors, skip=skipped, avg=avg)
+        )
+        # Sortie écrite en octets : base64 et lignes déjà encodées sont copiés tels quels
+        with open(output_path,'wb',buffering=1<<20) as f:
+            f.write((html_head + html_header).encode('utf-8'))
+            f.write("<div class='toolbar'>"
+                    "<input id='q' type='search' placeholder='Filtrer (fichier, artiste, titre, statut, MBID)…'>"
+                    "<a download='mb_rating_report.csv' href='data:text/csv;base64,".encode('utf-8'))
+            csv_f.seek(0)
+            for chunk in iter(lambda: csv_f.read(_B64_CHUNK), b''):
+                f.write(_b64.b64encode(chunk))
+            f.write(b"'>Exporter CSV</a></div>")
+            f.write((
+                "<div id='wrap'><table id='tbl'><thead><tr>"
+                "<th>Statut</th><th>Fichier</th><th>Artiste</th><th>Titre</th><th>Note</th><th>Votes</th><th>Durée</th>"
+                "<th>MBID</th><th>MBID RG</th><th>Fallback RG</th><th>Tags exotiques</th><th>Supprimés</th><th>Pochette</th><th>Message</th>"
+                "</tr></thead><tbody></tbody></table></div>"
+                "<noscript>JavaScript est nécessaire pour afficher le tableau (ou utilisez l'export CSV).</noscript>"
+                "<script id='data' type='application/json'>["
+            ).encode('utf-8'))
+            rows_f.seek(0)
+            shutil.copyfileobj(rows_f, f)
+            f.write(("]</script><script>" + _JS + "</script></body></html>").encode('utf-8'))
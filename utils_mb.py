@@ -4,24 +4,36 @@ import os
 import re
 import time
 import threading
+from contextlib import contextmanager
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
 from requests.exceptions import ConnectionError, ReadTimeout, ChunkedEncodingError
 from mutagen import File
 from mutagen.id3 import ID3, ID3NoHeaderError, TXXX, POPM
 from mutagen.flac import FLAC
 from mutagen.oggvorbis import OggVorbis
 from mutagen.oggopus import OggOpus
+from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4, MP4FreeForm
 
 API_ROOT = "https://musicbrainz.org/ws/2"
 LOG_FILE = "mb_rating_tag.log"
 AUDIO_EXTS = {".mp3", ".flac", ".ogg", ".opus", ".m4a", ".mp4", ".alac"}
+_MBID_RE = re.compile(r"^[0-9a-f-]{36}$", re.I)
+_MBID_TXXX_DESCS = frozenset({"musicbrainz track id","musicbrainz_trackid","musicbrainz recording id"})
 
 # ---- Ultra-strict throttle ----
 _MIN_INTERVAL = 1.5  # seconds between ANY two MB calls
 _last_call_ts = 0.0
 _lock = threading.Lock()
 _session = requests.Session()
+# Keep-alive vers musicbrainz.org : _rate_limit espace les requêtes de 1.5 s, une seule connexion sert à la fois
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
 
 # In-run caches (avoid repeated hits within same run)
 _mem_rating_rec = {}        # rec_mbid -> (value, votes) or None
@@ -29,6 +41,53 @@ _mem_releases_by_rec = {}   # rec_mbid -> first release MBID or None
 _mem_rgid_by_release = {}   # release_mbid -> rgid or None
 _mem_rating_rg = {}         # rgid -> (value, votes) or None
 
+# Fetches in progress, by (memo, key): parallel tracks of one album wait for the same request
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+@contextmanager
+def _single_flight(mem: dict, key):
+    """Serialize fetches of `key` for `mem`; callers re-check `mem` once inside."""
+    k = (id(mem), key)
+    with _inflight_lock:
+        ent = _inflight.get(k)
+        if ent is None:
+            ent = _inflight[k] = [threading.Lock(), 0]
+        ent[1] += 1
+    try:
+        with ent[0]:
+            yield
+    finally:
+        with _inflight_lock:
+            ent[1] -= 1
+            if not ent[1]:
+                del _inflight[k]
+
+
+# Persistent HTTP cache (MbCache or None), see set_http_cache()
+_http_cache = None
+
+
+def set_http_cache(cache):
+    """Serve MB GETs from `cache` (get_http/set_http/touch_http) across runs; None disables."""
+    global _http_cache
+    _http_cache = cache
+
+
+class _CachedResponse:
+    """Minimal stand-in for requests.Response built from a cached body."""
+    status_code = 200
+
+    def __init__(self, body: bytes):
+        self.content = body
+
+    def json(self):
+        return _loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
 
 def _rate_limit():
     global _last_call_ts
@@ -43,7 +102,18 @@ def _rate_limit():
 def _safe_get(url: str, headers: dict, params: dict, timeout: int = 15, retries: int = 3):
     """GET with throttle + manual retries & backoff. Returns requests.Response.
     Retries on ConnectionError/ReadTimeout/ChunkedEncodingError and HTTP 429/503.
+    With an HTTP cache set, fresh entries skip the network (and the throttle);
+    stale ones are revalidated with If-None-Match.
     """
+    cache = _http_cache
+    key = hit = None
+    if cache is not None:
+        key = url + "?" + urlencode(sorted(params.items()))
+        hit = cache.get_http(key)
+        if hit and hit[2]:
+            return _CachedResponse(hit[1])
+        if hit and hit[0]:
+            headers = dict(headers, **{"If-None-Match": hit[0]})
     backoff = 2.0
     for attempt in range(1, retries + 1):
         _rate_limit()
@@ -54,6 +124,12 @@ def _safe_get(url: str, headers: dict, params: dict, timeout: int = 15, retries:
                     time.sleep(backoff)
                     backoff *= 2
                     continue
+            if cache is not None:
+                if resp.status_code == 304 and hit:
+                    cache.touch_http(key)
+                    return _CachedResponse(hit[1])
+                if resp.status_code == 200:
+                    cache.set_http(key, resp.headers.get("ETag"), resp.content)
             return resp
         except (ConnectionError, ReadTimeout, ChunkedEncodingError):
             if attempt >= retries:
@@ -64,9 +140,34 @@ def _safe_get(url: str, headers: dict, params: dict, timeout: int = 15, retries:
 
 
 # ---------------- Log ----------------
+# Handle partagé ouvert par open_log() (main) : un seul open() par run, écritures bufferisées
+_log_fh = None
+_log_path = None
+_log_lock = threading.Lock()
+
+
+def open_log(log_file: str = LOG_FILE):
+    global _log_fh, _log_path
+    with _log_lock:
+        if _log_fh is None:
+            _log_fh = open(log_file, 'a', encoding='utf-8', errors='replace', buffering=1 << 15)
+            _log_path = log_file
+
+
+def close_log():
+    global _log_fh, _log_path
+    with _log_lock:
+        if _log_fh is not None:
+            try: _log_fh.close()
+            finally: _log_fh = None; _log_path = None
+
+
 def write_log(status: str, file_rel: str, details: str, log_file: str = LOG_FILE):
     ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-    line = f"{ts} | {status.upper()} | {file_rel} | {details}"
+    line = f"{ts} | {status.upper()} | {file_rel} | {details}\n"
+    with _log_lock:
+        if _log_fh is not None and log_file == _log_path:
+            _log_fh.write(line); return
     with open(log_file, 'a', encoding='utf-8', errors='replace') as f:
         f.write(line)
 
@@ -85,56 +186,80 @@ def read_string(v):
     return str(v)
 
 
+def load_id3(audio, path: str):
+    """Return the ID3 tags already parsed by mutagen, or read them from disk.
+    Raises ID3NoHeaderError like ID3(path). Save with id3.save(path, ...).
+    """
+    tags = getattr(audio, 'tags', None)
+    if isinstance(tags, ID3):
+        return tags
+    return ID3(path)
+
+
+# Format de tags par classe mutagen (File(..., easy=False)) : une recherche de dict par appel
+_TAG_FORMAT = {FLAC: 'vorbis', OggVorbis: 'vorbis', OggOpus: 'vorbis', MP4: 'mp4', MP3: 'id3'}
+
+
+def _tag_format(audio, path: str):
+    """'vorbis', 'mp4', 'id3' or None. Falls back to the extension for .mp3 read by another class."""
+    fmt = _TAG_FORMAT.get(type(audio))
+    if fmt is None and path.lower().endswith('.mp3'):
+        fmt = 'id3'
+    return fmt
+
+
 # --------------- MBID / Identity ---------------
-def extract_mb_recording_id(audio, path: str):
-    ext = os.path.splitext(path)[1].lower()
-    if isinstance(audio, (FLAC, OggVorbis, OggOpus)):
+def extract_mb_recording_id(audio, path: str, id3=None):
+    fmt = _tag_format(audio, path)
+    match = _MBID_RE.match
+    if fmt == 'vorbis':
         if audio.tags:
             for key in ("MUSICBRAINZ_TRACKID","MUSICBRAINZ_RECORDINGID","MB_TRACKID"):
                 val = audio.tags.get(key)
                 if val:
                     s = read_string(val)
-                    if s and re.match(r"^[0-9a-f-]{36}$", s, re.I):
+                    if s and match(s):
                         return s
-    if ext == ".mp3":
+    elif fmt == 'id3':
         try:
-            id3 = ID3(path)
+            if id3 is None: id3 = load_id3(audio, path)
             for frame in id3.getall("TXXX"):
                 desc = (frame.desc or '').strip().lower()
-                if desc in {"musicbrainz track id","musicbrainz_trackid","musicbrainz recording id"}:
+                if desc in _MBID_TXXX_DESCS:
                     text = read_string(frame.text)
-                    if text and re.match(r"^[0-9a-f-]{36}$", text, re.I):
+                    if text and match(text):
                         return text
         except ID3NoHeaderError:
             pass
-    if ext in {".m4a",".mp4"} and isinstance(audio, MP4):
+    elif fmt == 'mp4':
         for k in (audio.tags or {}).keys():
-            if k.lower().startswith("----:") and "musicbrainz" in k.lower() and "track" in k.lower():
+            kl = k.lower()
+            if kl.startswith("----:") and "musicbrainz" in kl and "track" in kl:
                 val = audio.tags.get(k)
                 s = read_string(val)
-                if s and re.match(r"^[0-9a-f-]{36}$", s, re.I):
+                if s and match(s):
                     return s
     return None
 
 
-def extract_basic_identity(audio, path: str):
-    ext = os.path.splitext(path)[1].lower()
+def extract_basic_identity(audio, path: str, id3=None):
+    fmt = _tag_format(audio, path)
     artist = title = None
     duration_ms = None
     if hasattr(audio, 'info') and getattr(audio.info, 'length', None):
         duration_ms = int(audio.info.length * 1000)
-    if isinstance(audio, (FLAC, OggVorbis, OggOpus)):
+    if fmt == 'vorbis':
         tags = audio.tags or {}
         artist = read_string(tags.get('ARTIST')) or read_string(tags.get('ALBUMARTIST'))
         title = read_string(tags.get('TITLE'))
-    elif ext == '.mp3':
+    elif fmt == 'id3':
         try:
-            id3 = ID3(path)
+            if id3 is None: id3 = load_id3(audio, path)
             artist = read_string(getattr(id3.get('TPE1'),'text',None))
             title = read_string(getattr(id3.get('TIT2'),'text',None))
         except ID3NoHeaderError:
             pass
-    elif ext in {'.m4a','.mp4'} and isinstance(audio, MP4):
+    elif fmt == 'mp4':
         tags = audio.tags or {}
         artist = read_string(tags.get('©ART'))
         title = read_string(tags.get('©nam'))
@@ -149,20 +274,23 @@ def _headers(ua: str):
 def mb_get_recording_rating(mbid: str, ua: str):
     if mbid in _mem_rating_rec:
         return _mem_rating_rec[mbid]
-    url = f"{API_ROOT}/recording/{mbid}"
-    params = {"inc":"ratings","fmt":"json"}
-    r = _safe_get(url, _headers(ua), params)
-    if r.status_code == 404:
-        _mem_rating_rec[mbid] = None
-        return None
-    r.raise_for_status()
-    data = r.json()
-    rating = data.get('rating', {})
-    val = rating.get('value')
-    votes = rating.get('votes-count')
-    out = (val, votes)
-    _mem_rating_rec[mbid] = out
-    return out
+    with _single_flight(_mem_rating_rec, mbid):
+        if mbid in _mem_rating_rec:
+            return _mem_rating_rec[mbid]
+        url = f"{API_ROOT}/recording/{mbid}"
+        params = {"inc":"ratings","fmt":"json"}
+        r = _safe_get(url, _headers(ua), params)
+        if r.status_code == 404:
+            _mem_rating_rec[mbid] = None
+            return None
+        r.raise_for_status()
+        data = _loads(r.content)
+        rating = data.get('rating', {})
+        val = rating.get('value')
+        votes = rating.get('votes-count')
+        out = (val, votes)
+        _mem_rating_rec[mbid] = out
+        return out
 
 
 def mb_search_recording(artist: str, title: str, duration_ms: int, ua: str):
@@ -173,7 +301,7 @@ def mb_search_recording(artist: str, title: str, duration_ms: int, ua: str):
     if r.status_code == 404:
         return None
     r.raise_for_status()
-    data = r.json()
+    data = _loads(r.content)
     recs = data.get('recordings') or []
     if not recs:
         return None
@@ -192,137 +320,166 @@ def mb_search_recording(artist: str, title: str, duration_ms: int, ua: str):
 def mb_get_first_release_id_for_recording(rec_mbid: str, ua: str):
     if rec_mbid in _mem_releases_by_rec:
         return _mem_releases_by_rec[rec_mbid]
-    url = f"{API_ROOT}/recording/{rec_mbid}"
-    params = {"inc":"releases","fmt":"json"}
-    r = _safe_get(url, _headers(ua), params)
-    if r.status_code == 404:
-        _mem_releases_by_rec[rec_mbid] = None
-        return None
-    r.raise_for_status()
-    data = r.json()
-    rels = data.get('releases') or []
-    rid = rels[0]['id'] if rels else None
-    _mem_releases_by_rec[rec_mbid] = rid
-    return rid
+    with _single_flight(_mem_releases_by_rec, rec_mbid):
+        if rec_mbid in _mem_releases_by_rec:
+            return _mem_releases_by_rec[rec_mbid]
+        url = f"{API_ROOT}/recording/{rec_mbid}"
+        params = {"inc":"releases","fmt":"json"}
+        r = _safe_get(url, _headers(ua), params)
+        if r.status_code == 404:
+            _mem_releases_by_rec[rec_mbid] = None
+            return None
+        r.raise_for_status()
+        data = _loads(r.content)
+        rels = data.get('releases') or []
+        rid = rels[0]['id'] if rels else None
+        _mem_releases_by_rec[rec_mbid] = rid
+        return rid
 
 
 def mb_get_release_group_id(release_mbid: str, ua: str):
     if release_mbid in _mem_rgid_by_release:
         return _mem_rgid_by_release[release_mbid]
-    url = f"{API_ROOT}/release/{release_mbid}"
-    params = {"inc":"release-groups","fmt":"json"}
-    r = _safe_get(url, _headers(ua), params)
-    if r.status_code == 404:
-        _mem_rgid_by_release[release_mbid] = None
-        return None
-    r.raise_for_status()
-    data = r.json()
-    rg = data.get('release-group') or {}
-    rgid = rg.get('id')
-    _mem_rgid_by_release[release_mbid] = rgid
-    return rgid
+    with _single_flight(_mem_rgid_by_release, release_mbid):
+        if release_mbid in _mem_rgid_by_release:
+            return _mem_rgid_by_release[release_mbid]
+        url = f"{API_ROOT}/release/{release_mbid}"
+        params = {"inc":"release-groups","fmt":"json"}
+        r = _safe_get(url, _headers(ua), params)
+        if r.status_code == 404:
+            _mem_rgid_by_release[release_mbid] = None
+            return None
+        r.raise_for_status()
+        data = _loads(r.content)
+        rg = data.get('release-group') or {}
+        rgid = rg.get('id')
+        _mem_rgid_by_release[release_mbid] = rgid
+        return rgid
 
 
 def mb_get_release_group_rating(rgid: str, ua: str):
     if rgid in _mem_rating_rg:
         return _mem_rating_rg[rgid]
-    url = f"{API_ROOT}/release-group/{rgid}"
-    params = {"inc":"ratings","fmt":"json"}
-    r = _safe_get(url, _headers(ua), params)
-    if r.status_code == 404:
-        _mem_rating_rg[rgid] = None
-        return None
-    r.raise_for_status()
-    data = r.json()
-    rating = data.get('rating', {})
-    val = rating.get('value')
-    votes = rating.get('votes-count')
-    out = (val, votes)
-    _mem_rating_rg[rgid] = out
-    return out
-
-
-# --------------- Write rating (recording) ---------------
-def write_rating_generic(audio, path: str, rating: float, votes: int, write_popm: bool):
-    ext = os.path.splitext(path)[1].lower()
+    with _single_flight(_mem_rating_rg, rgid):
+        if rgid in _mem_rating_rg:
+            return _mem_rating_rg[rgid]
+        url = f"{API_ROOT}/release-group/{rgid}"
+        params = {"inc":"ratings","fmt":"json"}
+        r = _safe_get(url, _headers(ua), params)
+        if r.status_code == 404:
+            _mem_rating_rg[rgid] = None
+            return None
+        r.raise_for_status()
+        data = _loads(r.content)
+        rating = data.get('rating', {})
+        val = rating.get('value')
+        votes = rating.get('votes-count')
+        out = (val, votes)
+        _mem_rating_rg[rgid] = out
+        return out
+
+
+# --------------- Write rating ---------------
+# Noms des tags par type de note : 'rec' (recording) / 'rg' (fallback release-group)
+_RATING_KEYS = {
+    'rec': ('RATING', 'MUSICBRAINZ_RATING', 'MUSICBRAINZ_RATING_VOTES'),
+    'rg': ('RATING_RG', 'MUSICBRAINZ_RG_RATING', 'MUSICBRAINZ_RG_RATING_VOTES'),
+}
+_REC_TXXX_LOWER = frozenset(k.lower() for k in _RATING_KEYS['rec'])
+
+
+def _stage_rating_tags(audio, path: str, kind: str, rating: float, votes: int, write_popm: bool = False, id3=None):
+    """Set the rating tags in memory only; commit_tags() writes the file.
+    Returns the ID3 object to commit for MP3s (None otherwise).
+    """
+    fmt = _tag_format(audio, path)
+    k_rating, k_mbr, k_votes = _RATING_KEYS[kind]
     rating_str = f"{rating:.1f}"
     votes_str = str(votes) if votes is not None else None
 
-    if isinstance(audio,(FLAC,OggVorbis,OggOpus)):
-        audio['RATING'] = rating_str
-        audio['MUSICBRAINZ_RATING'] = rating_str
-        if votes_str: audio['MUSICBRAINZ_RATING_VOTES'] = votes_str
-        audio.save(); return
-
-    if ext == '.mp3':
-        try: id3 = ID3(path)
-        except ID3NoHeaderError: id3 = ID3()
-        keep=[]
-        for f in id3.getall('TXXX'):
-            d=(f.desc or '').lower()
-            if d not in {'rating','musicbrainz_rating','musicbrainz_rating_votes'}:
-                keep.append(f)
-        id3.setall('TXXX', keep)
-        id3.add(TXXX(encoding=3, desc='RATING', text=rating_str))
-        id3.add(TXXX(encoding=3, desc='MUSICBRAINZ_RATING', text=rating_str))
+    if fmt == 'vorbis':
+        audio[k_rating] = rating_str
+        audio[k_mbr] = rating_str
+        if votes_str: audio[k_votes] = votes_str
+        return None
+
+    if fmt == 'id3':
+        if id3 is None:
+            try: id3 = load_id3(audio, path)
+            except ID3NoHeaderError: id3 = ID3()
+        if kind == 'rec':
+            id3.setall('TXXX', [f for f in id3.getall('TXXX') if (f.desc or '').lower() not in _REC_TXXX_LOWER])
+        id3.add(TXXX(encoding=3, desc=k_rating, text=rating_str))
+        id3.add(TXXX(encoding=3, desc=k_mbr, text=rating_str))
         if votes_str:
-            id3.add(TXXX(encoding=3, desc='MUSICBRAINZ_RATING_VOTES', text=votes_str))
+            id3.add(TXXX(encoding=3, desc=k_votes, text=votes_str))
         if write_popm:
             scaled = int(round((rating/5.0)*255))
             popms = [f for f in id3.getall('POPM') if getattr(f,'email','')!='musicbrainz@mb-rating']
             popms.append(POPM(email='musicbrainz@mb-rating', rating=scaled, count=0))
             id3.setall('POPM', popms)
-        id3.save(v2_version=3); return
-
-    if ext in {'.m4a','.mp4'} and isinstance(audio, MP4):
-        ff_rating = '----:com.apple.iTunes:RATING'
-        ff_mbr = '----:com.apple.iTunes:MUSICBRAINZ_RATING'
-        ff_votes = '----:com.apple.iTunes:MUSICBRAINZ_RATING_VOTES'
-        audio.tags[ff_rating] = [MP4FreeForm(rating_str.encode('utf-8'))]
-        audio.tags[ff_mbr] = [MP4FreeForm(rating_str.encode('utf-8'))]
+        return id3
+
+    if fmt == 'mp4':
+        audio.tags['----:com.apple.iTunes:' + k_rating] = [MP4FreeForm(rating_str.encode('utf-8'))]
+        audio.tags['----:com.apple.iTunes:' + k_mbr] = [MP4FreeForm(rating_str.encode('utf-8'))]
         if votes_str:
-            audio.tags[ff_votes] = [MP4FreeForm(votes_str.encode('utf-8'))]
-        audio.save(); return
+            audio.tags['----:com.apple.iTunes:' + k_votes] = [MP4FreeForm(votes_str.encode('utf-8'))]
+    return None
 
 
-# --------------- Write rating (release-group fallback) ---------------
-def write_rg_rating_tags(audio, path: str, rating: float, votes: int):
-    ext = os.path.splitext(path)[1].lower()
-    rating_str = f"{rating:.1f}"
-    votes_str = str(votes) if votes is not None else None
+def commit_tags(audio, path: str, id3=None):
+    """Single save for everything staged on `audio` (and `id3` for MP3s)."""
+    fmt = _tag_format(audio, path)
+    if fmt == 'id3':
+        if id3 is None:
+            try: id3 = load_id3(audio, path)
+            except ID3NoHeaderError: return
+        id3.save(path, v2_version=3)
+    elif fmt in ('vorbis', 'mp4'):
+        audio.save()
+
+
+def write_rating_generic(audio, path: str, rating: float, votes: int, write_popm: bool, id3=None):
+    id3 = _stage_rating_tags(audio, path, 'rec', rating, votes, write_popm, id3=id3)
+    commit_tags(audio, path, id3)
 
-    if isinstance(audio,(FLAC,OggVorbis,OggOpus)):
-        audio['RATING_RG'] = rating_str
-        audio['MUSICBRAINZ_RG_RATING'] = rating_str
-        if votes_str: audio['MUSICBRAINZ_RG_RATING_VOTES'] = votes_str
-        audio.save(); return
-
-    if ext == '.mp3':
-        try: id3 = ID3(path)
-        except ID3NoHeaderError: id3 = ID3()
-        id3.add(TXXX(encoding=3, desc='RATING_RG', text=rating_str))
-        id3.add(TXXX(encoding=3, desc='MUSICBRAINZ_RG_RATING', text=rating_str))
-        if votes_str:
-            id3.add(TXXX(encoding=3, desc='MUSICBRAINZ_RG_RATING_VOTES', text=votes_str))
-        id3.save(v2_version=3); return
-
-    if ext in {'.m4a','.mp4'} and isinstance(audio, MP4):
-        ff_rating = '----:com.apple.iTunes:RATING_RG'
-        ff_mbr = '----:com.apple.iTunes:MUSICBRAINZ_RG_RATING'
-        ff_votes = '----:com.apple.iTunes:MUSICBRAINZ_RG_RATING_VOTES'
-        audio.tags[ff_rating] = [MP4FreeForm(rating_str.encode('utf-8'))]
-        audio.tags[ff_mbr] = [MP4FreeForm(rating_str.encode('utf-8'))]
-        if votes_str:
-            audio.tags[ff_votes] = [MP4FreeForm(votes_str.encode('utf-8'))]
-        audio.save(); return
+
+# Release-group fallback
+def write_rg_rating_tags(audio, path: str, rating: float, votes: int, id3=None):
+    id3 = _stage_rating_tags(audio, path, 'rg', rating, votes, id3=id3)
+    commit_tags(audio, path, id3)
 
 
 # --------------- File iteration ---------------
+_EXTS_NO_DOT = frozenset(e[1:] for e in AUDIO_EXTS)
+
+
+def _scan_audio(dirpath: str):
+    # Même ordre et mêmes règles que os.walk : fichiers du dossier puis sous-dossiers, liens de dossiers non suivis
+    try:
+        it = os.scandir(dirpath)
+    except OSError:
+        return
+    subdirs = []
+    with it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink(): subdirs.append(entry.path)
+                continue
+            head, _, e = entry.name.rpartition('.')
+            if head.lstrip('.') and e.lower() in _EXTS_NO_DOT:
+                yield entry.path
+    for d in subdirs:
+        yield from _scan_audio(d)
+
+
 def iter_audio_files(root: str):
     if os.path.isfile(root):
         yield root
     else:
-        for dirpath, _, filenames in os.walk(root):
-            for fname in filenames:
-                if os.path.splitext(fname)[1].lower() in AUDIO_EXTS:
-                    yield os.path.join(dirpath, fname)
+        yield from _scan_audio(root)